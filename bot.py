@@ -1,14 +1,24 @@
 import asyncio
+import errno
+import itertools
+import json
 import logging
+import math
 import os
-import uuid
-import datetime
+import queue
+import shutil
+import subprocess
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
-from aiogram import Bot, Dispatcher, F
+import aiohttp
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.enums import ChatType
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, FSInputFile
+from aiogram.types import Message, BufferedInputFile, File
 from aiogram.exceptions import (
+    TelegramAPIError,
     TelegramBadRequest,
     TelegramServerError,
     TelegramNetworkError,
@@ -23,21 +33,87 @@ if not BOT_TOKEN:
 VIDEO_MAX_DURATION = int(os.getenv("VIDEO_MAX_DURATION", "90"))
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(20 * 1024 * 1024)))
 FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
-TMP_DIR = Path(os.getenv("TMP_DIR", "tmp"))
+FFPROBE_BIN = os.getenv("FFPROBE_BIN", "ffprobe")
+
+
+def _default_tmp_dir() -> str:
+    """
+    Временные файлы по возможности держим в RAM (tmpfs /dev/shm), если там хватает
+    места хотя бы на 4 файла максимального размера, иначе — /tmp.
+    """
+    try:
+        st = os.statvfs("/dev/shm")
+    except (AttributeError, OSError):
+        return "/tmp/circlebot"
+    if st.f_bavail * st.f_frsize >= MAX_FILE_SIZE * 4:
+        return "/dev/shm/circlebot"
+    return "/tmp/circlebot"
+
+
+TMP_DIR = Path(os.getenv("TMP_DIR") or _default_tmp_dir())
+
+# Сколько ffmpeg может работать одновременно, остальные видео ждут в очереди.
+# Ядра делятся между ними поровну, чтобы параллельные кодирования не мешали друг другу.
+CPU_COUNT = os.cpu_count() or 2
+FFMPEG_CONCURRENCY = max(1, int(os.getenv("FFMPEG_CONCURRENCY", str(max(1, CPU_COUNT - 1)))))
+FFMPEG_THREADS = math.ceil(CPU_COUNT / FFMPEG_CONCURRENCY)
+
+# Закреплять каждого воркера ffmpeg за своими ядрами (через taskset), чтобы потоки x264 не мигрировали
+FFMPEG_PIN_CPUS = os.getenv("FFMPEG_PIN_CPUS", "1") == "1"
+
+# limit для StreamReader-ов пайпов ffmpeg: ограничивает только буфер readline()/readuntil(),
+# на размер пайпов ОС и на чтение в communicate() не влияет
+FFMPEG_PIPE_LIMIT = 1 << 20
+
+# Скачивание из Telegram: файл режется на части по ~1 МБ, не больше DOWNLOAD_MAX_PARTS параллельных запросов;
+# DOWNLOAD_CHUNK_SIZE — размер чанка при чтении ответа и записи на диск
+DOWNLOAD_PART_SIZE = 1 << 20
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_MAX_PARTS = int(os.getenv("DOWNLOAD_MAX_PARTS", "8"))
+
+# Фрагментированный MP4 пишется за один проход, без перезаписи файла ради moov (как у +faststart)
+MP4_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof+separate_moof"
+
+# Зум до 640x640 без чёрных полей + кроп по центру
+SQUARE_FILTER = "scale=640:640:force_original_aspect_ratio=increase,crop=640:640"
+
+# Звук в этих кодеках кладём в MP4 без перекодирования
+COPY_AUDIO_CODECS = frozenset({"aac", "mp3"})
+
+# Сколько готовых кружочков помнить для повторной отправки по file_id
+NOTE_CACHE_SIZE = int(os.getenv("NOTE_CACHE_SIZE", "1024"))
+
+# Аппаратный энкодер: auto — проверить NVENC при старте, nvenc — включить принудительно, cpu — только libx264
+HW_ENCODER = os.getenv("HW_ENCODER", "auto").lower()
 
 # Chat ID администратора (твой личный chat_id). Сюда будет отправляться ТОЛЬКО видео, без данных о пользователе.
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0") or "0")
 
+# Уровень логов: в продакшене (Dockerfile) WARNING, чтобы не писать строку на каждый файл
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
 # Порт для HTTP-сервера (Render задаёт PORT автоматически)
 PORT = int(os.getenv("PORT", "10000"))
 
-START_TIME = datetime.datetime.utcnow()
+# Ответ healthcheck-а, одинаковый для всех запросов
+_HTTP_OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK"
 
 # ================== ЛОГИРОВАНИЕ ==================
 
+# Запись в stdout идёт в отдельном потоке QueueListener, event loop только кладёт записи в очередь
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+
+# Форматирует только StreamHandler слушателя, в очередь уходит исходный текст сообщения
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
 logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    level=LOG_LEVEL,
+    handlers=[_queue_handler],
 )
 logger = logging.getLogger("circlebot")
 
@@ -45,120 +121,449 @@ bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
 
+# Пути до ffmpeg/ffprobe ищутся в PATH один раз, а не при каждом запуске процесса
+_FFMPEG_PATH = shutil.which(FFMPEG_BIN) or FFMPEG_BIN
+_FFPROBE_PATH = shutil.which(FFPROBE_BIN) or FFPROBE_BIN
+_TASKSET_PATH = shutil.which("taskset")
+
+# Заполняется в main() по результату detect_nvenc()
+_HAS_NVENC = False
+
+# Уникальные имена временных файлов без uuid: PID процесса + счётчик
+TMP_DIR.mkdir(parents=True, exist_ok=True)
+_TMP_COUNTER = itertools.count()
+_PID = os.getpid()
+
+# Фоновые задачи (чистка tmp): ссылки нужны, чтобы задачи не собрал GC
+_background_tasks: set[asyncio.Task] = set()
+
+# file_unique_id исходного видео -> file_id отправленного кружочка
+_NOTE_CACHE: OrderedDict[str, str] = OrderedDict()
+
+# Общая aiohttp-сессия для параллельного скачивания файлов (создаётся лениво)
+_http_session: aiohttp.ClientSession | None = None
+
+
 # ================== УТИЛИТЫ ==================
 
 
-def build_ffmpeg_cmd(input_path: Path, output_path: Path) -> list[str]:
+def _probe_caps(ffmpeg_path: str) -> frozenset[str]:
+    """
+    Список энкодеров ffmpeg (`ffmpeg -encoders`), один раз при старте.
+    """
+    try:
+        result = subprocess.run(
+            [ffmpeg_path, "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            timeout=15,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return frozenset()
+
+    # Строки после "------" имеют вид " V....D libx264   описание"
+    _, _, listing = result.stdout.partition("------")
+    return frozenset(
+        parts[1] for parts in (line.split() for line in listing.splitlines()) if len(parts) >= 2
+    )
+
+
+# Список энкодеров снимается один раз при импорте
+_FFMPEG_CAPS = _probe_caps(_FFMPEG_PATH)
+
+
+def is_ready_video_note(streams: list[dict]) -> bool:
+    """
+    Видео уже квадратное 640x640 в H.264 — его можно не перекодировать.
+    """
+    video = next((st for st in streams if st.get("codec_type") == "video"), None)
+    return (
+        video is not None
+        and video.get("codec_name") == "h264"
+        and video.get("pix_fmt") == "yuv420p"
+        and video.get("width") == video.get("height") == 640
+    )
+
+
+def build_audio_args(streams: list[dict]) -> list[str]:
+    """
+    AAC/MP3 копируем как есть, остальное (или если ffprobe не справился)
+    перекодируем в AAC: кружочку хватает моно 44.1 кГц и 96 кбит/с.
+    """
+    audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+    if audio is not None and audio.get("codec_name") in COPY_AUDIO_CODECS:
+        return ["-c:a", "copy"]
+    return ["-c:a", "aac", "-b:a", "96k", "-ac", "1", "-ar", "44100"]
+
+
+def build_ffmpeg_cmd(input_path: Path, streams: list[dict], threads: int = FFMPEG_THREADS) -> list[str]:
     """
     ffmpeg:
     - делает квадрат 640x640
     - без чёрных полей: зум + кроп по центру
-    - видео H.264 (ultrafast), звук копируем как есть
+    - видео H.264: на GPU через NVENC, если он есть, иначе libx264 (ultrafast + zerolatency)
+    - если видео уже 640x640 H.264 — только перепаковка без перекодирования
+    - звук копируем, если он уже AAC/MP3, иначе перекодируем в AAC
+    - результат пишется в stdout (фрагментированный MP4, без временного файла)
     """
+    input_args = []
+    if is_ready_video_note(streams):
+        video_args = ["-c:v", "copy"]
+    elif _HAS_NVENC:
+        # Декодирование и кодирование на GPU, scale/crop 640x640 дешёвые и идут на CPU
+        input_args = ["-hwaccel", "cuda"]
+        video_args = [
+            "-vf",
+            SQUARE_FILTER,
+            "-c:v",
+            "h264_nvenc",
+            "-preset",
+            "p4",
+            "-tune",
+            "hq",
+            "-rc",
+            "vbr",
+            "-b:v",
+            "1200k",
+        ]
+    else:
+        video_args = [
+            "-vf",
+            SQUARE_FILTER,
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-tune",
+            "zerolatency",
+            "-crf",
+            "26",
+            "-threads",
+            str(threads),
+        ]
+
     return [
-        FFMPEG_BIN,
-        "-y",
+        _FFMPEG_PATH,
+        *input_args,
         "-i",
         str(input_path),
-        "-vf",
-        "scale=640:640:force_original_aspect_ratio=increase,crop=640:640",
-        "-c:v",
-        "libx264",
-        "-preset",
-        "ultrafast",
-        "-crf",
-        "28",
+        *video_args,
+        *build_audio_args(streams),
         "-movflags",
-        "+faststart",
-        "-c:a",
-        "copy",
-        str(output_path),
+        MP4_MOVFLAGS,
+        "-f",
+        "mp4",
+        "pipe:1",
     ]
 
 
-async def run_ffmpeg(cmd: list[str], timeout: int = 300) -> None:
+async def probe_streams(input_path: Path, timeout: int = 30) -> list[dict]:
     """
-    Асинхронный запуск ffmpeg с увеличенным таймаутом (300 сек).
+    ffprobe: кодек, размер и формат пикселей каждого потока.
+    Читает только заголовок файла. Если ffprobe не справился — пустой список
+    (тогда видео просто перекодируется).
     """
-    logger.info("Running ffmpeg: %s", " ".join(cmd))
+    cmd = [
+        _FFPROBE_PATH,
+        "-v",
+        "error",
+        "-show_entries",
+        "stream=codec_type,codec_name,width,height,pix_fmt",
+        "-of",
+        "json",
+        str(input_path),
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        logger.warning("ffprobe не найден: '%s'", FFPROBE_BIN)
+        return []
+
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        logger.warning("ffprobe превысил таймаут %s секунд", timeout)
+        return []
+
+    if process.returncode != 0:
+        return []
+
+    try:
+        return json.loads(stdout).get("streams", [])
+    except ValueError:
+        return []
+
+
+async def detect_nvenc() -> bool:
+    """
+    Проверяет, что h264_nvenc реально работает: кодирует пару кадров в никуда.
+    Одного списка `ffmpeg -encoders` мало — энкодер там есть и без GPU.
+    """
+    if HW_ENCODER == "nvenc":
+        return True
+    if HW_ENCODER != "auto" or "h264_nvenc" not in _FFMPEG_CAPS:
+        return False
+
+    cmd = [
+        _FFMPEG_PATH,
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-f",
+        "lavfi",
+        "-i",
+        "color=black:s=256x256:d=0.1",
+        "-c:v",
+        "h264_nvenc",
+        "-f",
+        "null",
+        "-",
+    ]
     try:
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        return False
+
+    try:
+        await asyncio.wait_for(process.wait(), timeout=15)
+    except asyncio.TimeoutError:
+        process.kill()
+        return False
+
+    return process.returncode == 0
+
+
+async def run_ffmpeg(cmd: list[str], timeout: int = 300) -> bytes:
+    """
+    Асинхронный запуск ffmpeg с увеличенным таймаутом (300 сек).
+    Возвращает то, что ffmpeg записал в stdout.
+    """
+    logger.debug("Running ffmpeg: %s", " ".join(cmd))
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
+            limit=FFMPEG_PIPE_LIMIT,
         )
     except FileNotFoundError:
         logger.error("ffmpeg не найден: '%s'", FFMPEG_BIN)
         raise RuntimeError("ffmpeg not found")
 
     try:
-        _, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
     except asyncio.TimeoutError:
         process.kill()
         logger.error("ffmpeg превысил таймаут %s секунд", timeout)
         raise RuntimeError("ffmpeg timeout")
+    except asyncio.CancelledError:
+        # Остановка бота: не оставляем ffmpeg работать после выхода
+        process.kill()
+        raise
 
     if process.returncode != 0:
         logger.error("ffmpeg error: %s", stderr.decode(errors="ignore"))
         raise RuntimeError("ffmpeg failed")
 
+    return stdout
+
+
+def split_cpus(parts: int) -> list[tuple[int, ...]]:
+    """
+    Делит доступные процессу ядра на `parts` непересекающихся групп подряд идущих ядер.
+    Если делить нечего (один воркер, ядер меньше, чем воркеров, или не Linux) —
+    группы пустые, и ffmpeg запускается без привязки.
+    """
+    if parts < 2 or not hasattr(os, "sched_getaffinity"):
+        return [()] * parts
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < parts:
+        return [()] * parts
+    return [tuple(cpus[i * len(cpus) // parts:(i + 1) * len(cpus) // parts]) for i in range(parts)]
+
+
+class FFmpegWorker:
+    """
+    Слот пула ffmpeg. Процесс ffmpeg на каждое видео свой (один процесс не умеет
+    писать несколько независимых файлов), а слот ограничивает их число.
+    """
+
+    def __init__(self, index: int, cpus: tuple[int, ...] = ()):
+        self.index = index
+        self.cpus = cpus
+
+    async def process(self, input_path: Path, timeout: int = 300) -> bytes:
+        streams = await probe_streams(input_path)
+        if self.cpus and _TASKSET_PATH:
+            # Потоков x264 столько же, сколько ядер у воркера, иначе они делят одно ядро
+            cmd = build_ffmpeg_cmd(input_path, streams, threads=len(self.cpus))
+            cmd = [_TASKSET_PATH, "-c", ",".join(map(str, self.cpus)), *cmd]
+        else:
+            cmd = build_ffmpeg_cmd(input_path, streams)
+        return await run_ffmpeg(cmd, timeout=timeout)
+
+
+class FFmpegPool:
+    """
+    Пул свободных воркеров ffmpeg на asyncio.Queue.
+    """
+
+    def __init__(self, size: int):
+        size = max(1, size)
+        cpu_sets = split_cpus(size) if FFMPEG_PIN_CPUS else [()] * size
+        self._idle: asyncio.Queue[FFmpegWorker] = asyncio.Queue()
+        for index in range(size):
+            self._idle.put_nowait(FFmpegWorker(index, cpu_sets[index]))
+
+    async def acquire(self) -> FFmpegWorker:
+        return await self._idle.get()
+
+    def release(self, worker: FFmpegWorker) -> None:
+        self._idle.put_nowait(worker)
+
+
+def file_size(path: Path) -> int:
+    """
+    Размер файла в байтах, 0 — если файла нет.
+    """
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def cleanup_paths(*paths: Path) -> None:
+    """
+    Удаляет временные файлы (вызывается в отдельном потоке).
+    """
+    for path in paths:
+        try:
+            os.unlink(path)
+            logger.debug("Temp file removed: %s", path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Не удалось удалить временный файл %s: %s", path, e)
+
+
+def spawn_background(coro) -> asyncio.Task:
+    """
+    Запускает корутину в фоне и держит ссылку на задачу, пока она не завершится.
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def remember_note(file_unique_id: str, note_file_id: str) -> None:
+    """
+    Запоминает file_id готового кружочка; самые старые записи вытесняются (LRU).
+    """
+    _NOTE_CACHE[file_unique_id] = note_file_id
+    _NOTE_CACHE.move_to_end(file_unique_id)
+    while len(_NOTE_CACHE) > NOTE_CACHE_SIZE:
+        _NOTE_CACHE.popitem(last=False)
+
 
 def human_size(num_bytes: int) -> str:
     mb = num_bytes / 1024 / 1024
     return f"{mb:.1f} МБ"
 
 
-# ================== ХЕНДЛЕРЫ ==================
+def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=120, sock_read=30),
+        )
+    return _http_session
 
 
-@dp.message(CommandStart())
-async def cmd_start(message: Message):
-    await message.answer(
-        "Привет! 👋\n"
-        "Я превращаю обычные видео в телеграм-кружочки.\n\n"
-        f"Ограничения:\n"
-        f"• Длительность: до {VIDEO_MAX_DURATION} сек\n"
-        f"• Размер: до {human_size(MAX_FILE_SIZE)}\n\n"
-        "Отправляя видео, ты соглашаешься на его техническую обработку для работы сервиса.\n\n"
-        "Просто пришли мне видео — я верну тебе кружочек 🟣\n\n"
-        "Буду рад подписке на мой канал @neirosueta 👋"
-    )
+async def _download_range(session: aiohttp.ClientSession, url: str, fd: int, start: int, end: int) -> None:
+    """
+    Скачивает байты [start, end] и пишет их в файл по своему смещению.
+    """
+    async with session.get(url, headers={"Range": f"bytes={start}-{end}"}) as resp:
+        if resp.status != 206:
+            raise RuntimeError(f"range request returned HTTP {resp.status}")
+        offset = start
+        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            await asyncio.to_thread(os.pwrite, fd, chunk, offset)
+            offset += len(chunk)
 
+    if offset != end + 1:
+        raise RuntimeError("range request returned incomplete data")
 
-@dp.message(Command("help"))
-async def cmd_help(message: Message):
-    await message.answer(
-        "Как пользоваться ботом:\n"
-        "1️⃣ Отправь обычное видео (не кружочек).\n"
-        f"2️⃣ Длительность — до {VIDEO_MAX_DURATION} секунд.\n"
-        f"3️⃣ Размер — до ~{human_size(MAX_FILE_SIZE)}.\n"
-        "4️⃣ Я обработаю его и отправлю в виде круглого видео (со звуком, без чёрных полос).\n\n"
-        "Видео может быть технически обработано для работы сервиса, но личные данные не передаются третьим лицам."
-    )
 
+async def download_file(file: File, destination: Path) -> None:
+    """
+    Скачивает файл из Telegram несколькими параллельными Range-запросами
+    в заранее выделенный файл. Для маленьких файлов, локального Bot API
+    или если сервер не отдаёт Range — обычный bot.download одним потоком.
+    """
+    size = file.file_size or 0
+    parts = min(DOWNLOAD_MAX_PARTS, math.ceil(size / DOWNLOAD_PART_SIZE))
+    if parts < 2 or bot.session.api.is_local:
+        await bot.download(file, destination=destination, chunk_size=DOWNLOAD_CHUNK_SIZE)
+        return
 
-@dp.message(Command("health"))
-async def cmd_health(message: Message):
-    await message.answer("✅ Бот в строю и готов к работе.")
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    part_size = math.ceil(size / parts)
+    session = get_http_session()
 
+    fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except AttributeError:
+            os.ftruncate(fd, size)
+        except OSError as e:
+            # ФС не умеет fallocate — обходимся разреженным файлом; ENOSPC и прочее пробрасываем
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+            os.ftruncate(fd, size)
+
+        results = await asyncio.gather(
+            *(
+                _download_range(session, url, fd, start, min(start + part_size, size) - 1)
+                for start in range(0, size, part_size)
+            ),
+            return_exceptions=True,
+        )
+    finally:
+        os.close(fd)
+
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        # В тексте ошибок aiohttp есть URL с токеном бота, поэтому логируем только тип
+        logger.warning(
+            "Параллельное скачивание не удалось (%s), качаю одним потоком",
+            type(errors[0]).__name__,
+        )
+        await bot.download(file, destination=destination, chunk_size=DOWNLOAD_CHUNK_SIZE)
 
-@dp.message(F.text)
-async def handle_text(message: Message):
-    if message.text.startswith("/"):
-        await message.answer("Не знаю такую команду 🤔 Попробуй /start, /help или просто пришли видео.")
-    else:
-        await message.answer("Пришли мне обычное видео — я сделаю из него кружочек 🟣")
 
+ffmpeg_pool = FFmpegPool(FFMPEG_CONCURRENCY)
 
-@dp.message(F.video_note)
-async def handle_video_note(message: Message):
-    await message.answer(
-        "Ты отправил уже кружочек 😊\n"
-        "Пришли обычное видео, чтобы я сделал кружок из него."
-    )
 
+# ================== ХЕНДЛЕРЫ ==================
+
+# Порядок регистрации = порядок проверки фильтров: видео чаще всего, текстовый catch-all последним
+router = Router()
 
-@dp.message(F.video)
+
+@router.message(F.video)
 async def handle_video(message: Message):
     video = message.video
     logger.info(
@@ -178,6 +583,17 @@ async def handle_video(message: Message):
         except Exception as e:
             logger.warning("Не удалось переслать видео администратору: %s", e)
 
+    # Это видео уже превращали в кружочек — отправляем готовый по file_id
+    cached_note_id = _NOTE_CACHE.get(video.file_unique_id)
+    if cached_note_id is not None:
+        _NOTE_CACHE.move_to_end(video.file_unique_id)
+        try:
+            await bot.send_video_note(chat_id=message.chat.id, video_note=cached_note_id)
+            return
+        except TelegramAPIError as e:
+            logger.warning("Кэшированный кружочек не отправился, обрабатываю заново: %s", e)
+            _NOTE_CACHE.pop(video.file_unique_id, None)
+
     if video.duration and video.duration > VIDEO_MAX_DURATION:
         await message.answer(
             f"Видео слишком длинное ({video.duration} сек). "
@@ -194,10 +610,8 @@ async def handle_video(message: Message):
 
     status_msg = await message.answer("Принял видео, обрабатываю кружочек... 🔄")
 
-    TMP_DIR.mkdir(exist_ok=True)
-    tmp_id = uuid.uuid4().hex
+    tmp_id = f"{_PID}_{next(_TMP_COUNTER)}"
     input_path = TMP_DIR / f"in_{tmp_id}.mp4"
-    output_path = TMP_DIR / f"out_{tmp_id}.mp4"
 
     try:
         # --- Скачивание ---
@@ -216,10 +630,10 @@ async def handle_video(message: Message):
             )
             return
 
-        logger.info("Downloading video file_id=%s to %s", video.file_id, input_path)
-        await bot.download(file, destination=input_path)
+        logger.debug("Downloading video file_id=%s to %s", video.file_id, input_path)
+        await download_file(file, input_path)
 
-        if not input_path.exists() or input_path.stat().st_size == 0:
+        if not await asyncio.to_thread(file_size, input_path):
             logger.error("Файл после скачивания отсутствует или пустой: %s", input_path)
             await status_msg.edit_text(
                 "Не удалось корректно скачать видео из Telegram (файл пустой). Попробуй ещё раз."
@@ -227,24 +641,29 @@ async def handle_video(message: Message):
             return
 
         # --- Конвертация ---
-        cmd = build_ffmpeg_cmd(input_path, output_path)
-        await run_ffmpeg(cmd)
+        worker = await ffmpeg_pool.acquire()
+        try:
+            data = await worker.process(input_path)
+        finally:
+            ffmpeg_pool.release(worker)
 
-        if not output_path.exists() or output_path.stat().st_size == 0:
-            logger.error("Выходной файл после ffmpeg отсутствует или пустой: %s", output_path)
+        if not data:
+            logger.error("ffmpeg ничего не записал в stdout для %s", input_path)
             await status_msg.edit_text(
                 "ffmpeg не смог создать корректное видео для кружочка. Попробуй другое видео."
             )
             return
 
         # --- Отправка кружочка ---
-        logger.info("Sending video_note from %s (size=%s bytes)", output_path, output_path.stat().st_size)
-        video_note = FSInputFile(output_path)
+        logger.debug("Sending video_note for %s (size=%s bytes)", input_path, len(data))
+        video_note = BufferedInputFile(data, filename="circle.mp4")
 
         try:
-            await bot.send_video_note(
+            sent = await bot.send_video_note(
                 chat_id=message.chat.id,
                 video_note=video_note,
+                duration=video.duration,
+                length=640,
             )
         except TelegramBadRequest as e:
             logger.error("TelegramBadRequest при send_video_note: %s", e)
@@ -267,6 +686,9 @@ async def handle_video(message: Message):
             )
             return
 
+        if sent.video_note is not None:
+            remember_note(video.file_unique_id, sent.video_note.file_id)
+
         await status_msg.edit_text("Готово! Вот твой кружочек 🟣")
 
     except RuntimeError as e:
@@ -284,68 +706,89 @@ async def handle_video(message: Message):
         except Exception:
             pass
     finally:
-        for path in (input_path, output_path):
-            try:
-                if path.exists():
-                    path.unlink()
-                    logger.info("Temp file removed: %s", path)
-            except Exception as cleanup_err:
-                logger.warning("Не удалось удалить временный файл %s: %s", path, cleanup_err)
+        # Удаление не задерживает ответ пользователю
+        spawn_background(asyncio.to_thread(cleanup_paths, input_path))
+
 
+@router.message(F.video_note)
+async def handle_video_note(message: Message):
+    await message.answer(
+        "Ты отправил уже кружочек 😊\n"
+        "Пришли обычное видео, чтобы я сделал кружок из него."
+    )
+
+
+@router.message(Command("health"))
+async def cmd_health(message: Message):
+    await message.answer("✅ Бот в строю и готов к работе.")
+
+
+@router.message(CommandStart())
+async def cmd_start(message: Message):
+    await message.answer(
+        "Привет! 👋\n"
+        "Я превращаю обычные видео в телеграм-кружочки.\n\n"
+        f"Ограничения:\n"
+        f"• Длительность: до {VIDEO_MAX_DURATION} сек\n"
+        f"• Размер: до {human_size(MAX_FILE_SIZE)}\n\n"
+        "Отправляя видео, ты соглашаешься на его техническую обработку для работы сервиса.\n\n"
+        "Просто пришли мне видео — я верну тебе кружочек 🟣\n\n"
+        "Буду рад подписке на мой канал @neirosueta 👋"
+    )
+
+
+@router.message(Command("help"))
+async def cmd_help(message: Message):
+    await message.answer(
+        "Как пользоваться ботом:\n"
+        "1️⃣ Отправь обычное видео (не кружочек).\n"
+        f"2️⃣ Длительность — до {VIDEO_MAX_DURATION} секунд.\n"
+        f"3️⃣ Размер — до ~{human_size(MAX_FILE_SIZE)}.\n"
+        "4️⃣ Я обработаю его и отправлю в виде круглого видео (со звуком, без чёрных полос).\n\n"
+        "Видео может быть технически обработано для работы сервиса, но личные данные не передаются третьим лицам."
+    )
+
+
+@router.message(F.chat.type == ChatType.PRIVATE)
+async def handle_text(message: Message):
+    # Последний хендлер ловит всё остальное. Отвечаем только на неизвестные команды в личке:
+    # известные уже разобраны выше, а обычный текст, фото, стикеры и т.п. молча пропускаем,
+    # чтобы не тратить запрос к Telegram API на каждое сообщение
+    text = message.text
+    if not text or text[0] != "/":
+        return
+    await message.answer("Не знаю такую команду 🤔 Попробуй /start, /help или просто пришли видео.")
 
-# ================== МИНИ HTTP-СЕРВЕР ДЛЯ RENDER + СТАТУС ==================
+
+dp.include_router(router)
+
+
+# ================== МИНИ HTTP-СЕРВЕР ДЛЯ RENDER ==================
 
 
 async def handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     """
-    HTTP-эндпоинт:
-    - отвечает 200 OK
-    - отдаёт простую HTML-страницу со статусом и аптаймом
-    Используется для Render healthcheck и UptimeRobot.
+    HTTP-эндпоинт для Render healthcheck и UptimeRobot: всегда 200 OK.
+    Ответ собран заранее, запрос не разбираем.
     """
     try:
+        # Читаем запрос, иначе close() с непрочитанными данными отправит RST вместо ответа
         await reader.read(1024)
     except Exception:
         pass
 
-    now = datetime.datetime.utcnow()
-    uptime = now - START_TIME
-    uptime_str = str(uptime).split(".")[0]
-
-    html = f"""
-    <html>
-    <head><title>AI Circle Bot Status</title></head>
-    <body>
-      <h1>🟢 Bot is running</h1>
-      <p><b>Uptime:</b> {uptime_str}</p>
-      <p><b>UTC Time:</b> {now:%Y-%m-%d %H:%M:%S}</p>
-      <p>Telegram polling: active</p>
-    </body>
-    </html>
-    """
-
-    data = html.encode("utf-8")
-    headers = (
-        "HTTP/1.1 200 OK\r\n"
-        "Content-Type: text/html; charset=utf-8\r\n"
-        f"Content-Length: {len(data)}\r\n"
-        "Connection: close\r\n\r\n"
-    ).encode("utf-8")
-
-    writer.write(headers + data)
-    try:
-        await writer.drain()
-    except Exception:
-        pass
+    writer.write(_HTTP_OK)
     writer.close()
-    try:
-        await writer.wait_closed()
-    except Exception:
-        pass
 
 
 async def start_http_server():
-    server = await asyncio.start_server(handle_http, "0.0.0.0", PORT)
+    server = await asyncio.start_server(
+        handle_http,
+        "0.0.0.0",
+        PORT,
+        backlog=128,
+        start_serving=True,
+    )
     logger.info("HTTP server listening on 0.0.0.0:%s", PORT)
     async with server:
         await server.serve_forever()
@@ -355,22 +798,49 @@ async def start_http_server():
 
 
 async def main():
+    # Остатки от прошлого запуска (если процесс упал, finally в handle_video не сработал).
+    # Удаляем только свои файлы: TMP_DIR может указывать на общую папку.
+    await asyncio.to_thread(cleanup_paths, *TMP_DIR.glob("in_*.mp4"))
+
+    global _HAS_NVENC
+    _HAS_NVENC = await detect_nvenc()
+    logger.info("Video encoder: %s", "h264_nvenc" if _HAS_NVENC else "libx264")
+
+    logger.info("Event loop: %s", type(asyncio.get_running_loop()).__module__)
+
     logger.info(
         "Starting bot polling + HTTP server... VIDEO_MAX_DURATION=%s, MAX_FILE_SIZE=%s, FFMPEG_BIN=%s, PORT=%s",
         VIDEO_MAX_DURATION,
         MAX_FILE_SIZE,
-        FFMPEG_BIN,
+        _FFMPEG_PATH,
         PORT,
     )
 
-    bot_task = asyncio.create_task(dp.start_polling(bot))
-    http_task = asyncio.create_task(start_http_server())
-
-    await asyncio.gather(bot_task, http_task)
+    try:
+        # Если HTTP-сервер упадёт, TaskGroup отменит polling (и наоборот) — процесс не зависнет наполовину живым
+        async with asyncio.TaskGroup() as tg:
+            http_task = tg.create_task(start_http_server())
+            # aiogram сам ловит SIGTERM/SIGINT и штатно завершает polling, после чего гасим HTTP-сервер
+            await dp.start_polling(bot)
+            http_task.cancel()
+    finally:
+        if _http_session is not None:
+            await _http_session.close()
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+
+    if uvloop is not None:
+        # Событийный цикл на libuv: дешевле сокеты, пайпы ffmpeg и ожидание дочерних процессов
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped.")
+    finally:
+        _log_listener.stop()